@@ -31,22 +31,43 @@ Generates a BOM or CPL csv file compatible with:
 """
 
 
+import io
 import os
+import re
 import sys
 import csv
-
-from xml.etree import ElementTree
-from collections import OrderedDict
+import shutil
+
+from itertools import repeat
+from operator import attrgetter
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from lxml import etree as ElementTree
+    g_xmlparser = {'huge_tree': True,
+                   'collect_ids': False,
+                   'tag': ('components', 'comp', 'libparts', 'libpart', 'nets', 'net')}
+    g_supplierpath = ElementTree.XPath('./fields/field[@name="Supplier"]/text()',
+                                      smart_strings=False)
+except ImportError:
+    from xml.etree import ElementTree
+    g_xmlparser = {}
+    g_supplierpath = None
 
 
 g_bomext = 'BOM'
 g_cplext = 'CPL'
+g_bufsize = 1 << 20
+g_workers = 4
+g_sections = {'components': 'comp', 'libparts': 'libpart', 'nets': 'net'}
+g_csvsplit = re.compile(r',(?=(?:[^"]*"[^"]*")*[^"]*$)')
 g_posfiles = ('all-pos', 'top-pos', 'bottom-pos')
 g_rotations = {'Reference': 0, 'Value': 5, 'Format': '%.6f'}
 
 g_suppliers = {}
 g_suppliers['Default'] = {}
-g_suppliers['Default']['fields'] = OrderedDict()
+g_suppliers['Default']['fields'] = {}
 g_suppliers['Default']['fields']['Quantity'] = 'Quantity'
 g_suppliers['Default']['fields']['Manufacture Part Number'] = 'PartNumber'
 g_suppliers['Default']['fields']['Manufacturer'] = 'Manufacturer'
@@ -62,7 +83,7 @@ g_suppliers['Default']['grouped'] = True
 g_suppliers['Default']['generatecpl'] = False
 
 g_suppliers['LCSC'] = {}
-g_suppliers['LCSC']['fields'] = OrderedDict()
+g_suppliers['LCSC']['fields'] = {}
 g_suppliers['LCSC']['fields']['Quantity'] = 'Quantity'
 g_suppliers['LCSC']['fields']['Manufacture Part Number'] = 'PartNumber'
 g_suppliers['LCSC']['fields']['Manufacturer'] = 'Manufacturer'
@@ -78,7 +99,7 @@ g_suppliers['LCSC']['grouped'] = True
 g_suppliers['LCSC']['generatecpl'] = False
 
 g_suppliers['JLCPCB'] = {}
-g_suppliers['JLCPCB']['fields'] = OrderedDict()
+g_suppliers['JLCPCB']['fields'] = {}
 g_suppliers['JLCPCB']['fields']['Comment'] = 'value'
 g_suppliers['JLCPCB']['fields']['Designator'] = 'ref'
 g_suppliers['JLCPCB']['fields']['Footprint'] = 'footprint'
@@ -97,19 +118,23 @@ g_suppliers['JLCPCB']['cplheaders'] = {0: 'Designator',
                                        6: 'Layer'}
 
 
-def getEqual(supplier):
-    if supplier in g_suppliers:
-        return g_suppliers[supplier]['equal']
-    return g_suppliers['Default']['equal']
+def getSupplierText(component):
+    if g_supplierpath is not None:
+        texts = g_supplierpath(component)
+        return texts[0] if texts else None
+    supplier = component.find('./fields/field[@name="Supplier"]')
+    if supplier is not None:
+        return supplier.text
+    return None
+
+def getConfig(supplier):
+    return g_suppliers.get(supplier, g_suppliers['Default'])
 
 def getSorted(supplier):
     if supplier in g_suppliers:
         return g_suppliers[supplier]['sorted']
     return g_suppliers['Default']['sorted']
 
-def getValid(supplier):
-    return getEqual(supplier) + getSorted(supplier)
-
 def needGrouping(supplier):
     if supplier in g_suppliers:
         return g_suppliers[supplier]['grouped']
@@ -154,6 +179,9 @@ def getInputs(path):
         inputs.append(getInput(path, post))
     return inputs
 
+def getPosition(path):
+    return next((i for i in getInputs(path) if os.path.isfile(i)), None)
+
 def getInput(path, post, ext='csv'):
     return "%s-%s.%s" % (path, post, ext)
 
@@ -179,7 +207,11 @@ def getFloat(string, default=0):
 
 class Component(object):
     def __init__(self, component):
-        self.ref = component.attrib['ref']
+        self.ref = component.get('ref')
+        supplier = getSupplierText(component)
+        self._supplier = supplier.strip() if supplier is not None else ''
+        if self._supplier == '':
+            return
         value = component.find('value')
         if value is not None:
             self.value = value.text.strip()
@@ -190,11 +222,6 @@ class Component(object):
             self.footprint = footprint.text.strip().split(':').pop()
         else:
             self.footprint = ''
-        supplier = component.find('./fields/field[@name="Supplier"]')
-        if supplier is not None:
-            self._supplier = supplier.text.strip()
-        else:
-            self._supplier = ''
         self.Manufacturer = ''
         self.PartNumber = ''
         self.SupplierRef = ''
@@ -204,53 +231,43 @@ class Component(object):
     @property
     def isvalid(self):
         if self._supplier != '':
-            self.Supplier = self._supplier.upper()
-            self._sorted = getSorted(self.Supplier)
-            self._equal = getEqual(self.Supplier)
+            self.Supplier = sys.intern(self._supplier.upper())
+            config = getConfig(self.Supplier)
+            self._sorted = config['sorted']
+            self._equal = config['equal']
             return True
         return False
 
-    def __eq__(self, other):
-        if self.Supplier != other.Supplier:
-            return False
-        for a in self._equal:
-            if getattr(self, a) != getattr(other, a):
-                return False
-        return True
-
-    def __lt__(self, other):
-        if self.Supplier != other.Supplier:
-            return self.Supplier < other.Supplier
-        for a in self._sorted:
-            if getattr(self, a) != getattr(other, a):
-                return getattr(self, a) < getattr(other, a)
-        return False
+    @property
+    def key(self):
+        return (self.Supplier, ) + tuple(getattr(self, a) for a in self._equal)
 
-    def setCustomFields(self, fields, suppliers):
-        manufacturer = fields.find('./field[@name="Manufacturer"]')
-        if manufacturer is not None:
-            self.Manufacturer = manufacturer.text.strip()
-        partnumber = fields.find('./field[@name="PartNumber"]')
-        if partnumber is not None:
-            self.PartNumber = partnumber.text.strip()
-        reference = fields.find('./field[@name="%sRef"]' % self._supplier)
-        if reference is not None:
-            self.SupplierRef = reference.text.strip()
-        else:
-            reference = fields.find('./field[@name="SupplierRef"]')
-            if reference is not None:
-                self.SupplierRef = reference.text.strip()
-        rotation = fields.find('./field[@name="Rotation"]')
-        if rotation is not None:
-            self.Rotation = getInteger(rotation.text.strip(), 0)
-        quantity = fields.find('./field[@name="Quantity"]')
-        if quantity is not None:
-            self.Quantity = getInteger(quantity.text.strip(), 0, 0)
-        if all((getattr(self, a) for a in getValid(self.Supplier))):
-            if self.Supplier not in suppliers:
-                suppliers.append(self.Supplier)
-            return True
-        return False
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def setCustomFields(self, fields):
+        values = {}
+        for field in fields:
+            name = field.get('name')
+            if name not in values:
+                values[name] = (field.text or '').strip()
+        if 'Manufacturer' in values:
+            self.Manufacturer = sys.intern(values['Manufacturer'])
+        if 'PartNumber' in values:
+            self.PartNumber = values['PartNumber']
+        reference = '%sRef' % self._supplier
+        if reference in values:
+            self.SupplierRef = values[reference]
+        elif 'SupplierRef' in values:
+            self.SupplierRef = values['SupplierRef']
+        if 'Rotation' in values:
+            self.Rotation = getInteger(values['Rotation'], 0)
+        if 'Quantity' in values:
+            self.Quantity = getInteger(values['Quantity'], 0, 0)
+        return all((getattr(self, a) for a in self._equal + self._sorted))
 
 
 def generateBom(xml, path, quantity):
@@ -260,94 +277,148 @@ def generateBom(xml, path, quantity):
 
 
 def parseXml(xml, quantity):
-    tree = ElementTree.parse(xml)
-    root = tree.getroot()
-    suppliers = []
-    components = []
+    suppliers = set()
+    components = defaultdict(list)
+    groups = {}
     missings = []
-    for c in root.findall('./components/'):
-        component = Component(c)
-        if not component.isvalid:
-            missings.append(component.ref)
-            continue
-        fields = c.find('fields')
-        if not component.setCustomFields(fields, suppliers):
-            missings.append(component.ref)
-            continue
-        if component.Quantity == 0:
-            missings.append(component.ref)
-            continue
-        if needGrouping(component.Supplier):
-            component.Quantity *= quantity
-            exist = next((c for c in components if c == component), None)
-            if exist is None:
-                components.append(component)
-            else:
-                exist.Quantity += component.Quantity
+    parent = None
+    for event, c in ElementTree.iterparse(xml, ('start', 'end'), **g_xmlparser):
+        if c.tag in g_sections:
+            parent = c if event == 'start' else None
+        elif event == 'end' and parent is not None and c.tag == g_sections[parent.tag]:
+            if c.tag == 'comp':
+                parseComponent(c, quantity, suppliers, components, groups, missings)
+            c.clear()
+            parent.remove(c)
+    return sorted(suppliers), components, missings
+
+
+def parseComponent(c, quantity, suppliers, components, groups, missings):
+    component = Component(c)
+    if not component.isvalid:
+        missings.append(component.ref)
+        return
+    fields = c.find('fields')
+    if not component.setCustomFields(fields):
+        missings.append(component.ref)
+        return
+    suppliers.add(component.Supplier)
+    if component.Quantity == 0:
+        missings.append(component.ref)
+        return
+    if needGrouping(component.Supplier):
+        component.Quantity *= quantity
+        key = component.key
+        exist = groups.get(key)
+        if exist is None:
+            groups[key] = component
+            components[component.Supplier].append(component)
         else:
-            components.extend([component for c in range(component.Quantity)])
-    return sorted(suppliers), sorted(components), missings
+            exist.Quantity += component.Quantity
+    else:
+        components[component.Supplier].append(component)
 
 
 def writeCsv(suppliers, components, path):
+    def write(supplier):
+        return writeSupplierCsv(supplier, components.get(supplier, ()), path)
     rotations = {}
-    for supplier in suppliers:
-        if needCpl(supplier) and supplier not in rotations:
-            rotations[supplier] = {}
-        out = getOutput(path, supplier, g_bomext)
-        columns = getFields(supplier).keys()
-        delimiter = getDelimiter(supplier)
-        quotechar = getQuotechar(supplier)
-        quoting = getQuoting(supplier)
-        fields = getFields(supplier).items()
-        with open(out, 'w') as csvfile:
-            c = csv.DictWriter(csvfile,
-                               fieldnames = columns,
-                               delimiter = delimiter,
-                               quotechar = quotechar,
-                               quoting = quoting)
-            c.writeheader()
-            while(len(components) and components[0].Supplier == supplier):
-                row = {}
-                component = components.pop(0)
-                for key, value in fields:
-                    row[key] = getattr(component, value)
-                c.writerow(row)
-                if needCpl(supplier) and component.Rotation != 0:
-                    rotations[supplier][component.ref] = component.Rotation
+    for supplier, rotation in zip(suppliers, runParallel(write, suppliers)):
+        if rotation is not None:
+            rotations[supplier] = rotation
+    return rotations
+
+
+def writeSupplierCsv(supplier, components, path):
+    rotations = None
+    rows = sorted(components, key=attrgetter(*getSorted(supplier)))
+    if needCpl(supplier):
+        rotations = {component.ref: component.Rotation
+                     for component in rows
+                     if component.Rotation != 0}
+    out = getOutput(path, supplier, g_bomext)
+    columns = getFields(supplier).keys()
+    delimiter = getDelimiter(supplier)
+    quotechar = getQuotechar(supplier)
+    quoting = getQuoting(supplier)
+    grouped = needGrouping(supplier)
+    values = tuple(getFields(supplier).values())
+    with open(out, 'w', newline='', encoding='utf-8', buffering=g_bufsize) as csvfile:
+        c = csv.writer(csvfile,
+                       delimiter = delimiter,
+                       quotechar = quotechar,
+                       quoting = quoting)
+        c.writerow(columns)
+        c.writerows(row
+                    for component in rows
+                    for row in repeat([getattr(component, value) for value in values],
+                                      1 if grouped else component.Quantity))
     return rotations
 
 
 def generateCpl(suppliers, path):
-    rotations = {}
+    position = getPosition(path)
+    def copy(supplier):
+        return copySupplierCsv(supplier, suppliers[supplier], path, position)
+    return dict(zip(suppliers, runParallel(copy, suppliers)))
+
+
+def copySupplierCsv(supplier, rotations, path, position):
+    if position is None:
+        return False
     ref = getRotations('Reference')
     value = getRotations('Value')
     format = getRotations('Format')
-    for supplier in suppliers:
-        rotations[supplier] = False
-        for i in getInputs(path):
-            if os.path.isfile(i):
-                out = getOutput(path, supplier, g_cplext)
-                headers = getHeaders(supplier)
-                copyCsv(i, out, headers, suppliers[supplier], ref, value, format)
-                rotations[supplier] = True
-                break
-    return rotations
+    out = getOutput(path, supplier, g_cplext)
+    headers = getHeaders(supplier)
+    copyCsv(position, out, headers, rotations, ref, value, format)
+    return True
+
+
+def runParallel(function, suppliers):
+    workers = min(g_workers, len(suppliers))
+    if workers < 2:
+        return [function(supplier) for supplier in suppliers]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, suppliers))
 
 
 def copyCsv(i, o, headers, rotations, ref, value, format):
-    with open(i) as r, open(o, 'w') as w:
-        reader = csv.reader(r)
-        writer = csv.writer(w)
-        header = next(reader)
+    with open(i, 'rb') as r, open(o, 'wb', buffering=g_bufsize) as w:
+        line = r.readline().decode('utf-8')
+        header = next(csv.reader([line]))
         for k, v in headers.items():
-           header[k] = v
-        writer.writerow(header)
-        for row in reader:
-            if row[ref] in rotations:
-                rotation = getFloat(row[value]) + rotations[row[ref]]
-                row[value] = format % rotation
-            writer.writerow(row)
+            header[k] = v
+        terminator = '\r\n' if line.endswith('\r\n') else '\n'
+        text = io.StringIO()
+        csv.writer(text, lineterminator=terminator).writerow(header)
+        w.write(text.getvalue().encode('utf-8'))
+        if not rotations:
+            shutil.copyfileobj(r, w, g_bufsize)
+            return
+        for line in r:
+            if getCsvField(line, ref) in rotations:
+                line = rotateCsvLine(line, rotations, ref, value, format)
+            w.write(line)
+
+
+def getCsvField(line, index):
+    fields = line.split(b',', index + 1)
+    if len(fields) > index:
+        return fields[index].strip().strip(b'"').decode('utf-8')
+    return None
+
+
+def rotateCsvLine(line, rotations, ref, value, format):
+    text = line.decode('utf-8')
+    row = next(csv.reader([text]))
+    if row[ref] not in rotations:
+        return line
+    body = text.rstrip('\r\n')
+    fields = g_csvsplit.split(body)
+    rotation = getFloat(row[value]) + rotations[row[ref]]
+    fields[value] = format % rotation
+    return (','.join(fields) + text[len(body):]).encode('utf-8')
 
 
 def getArguments():